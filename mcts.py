@@ -26,14 +26,62 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-from tictactoe import Board, CROSS, NOUGHT, search
+from tictactoe import Board, CROSS, NOUGHT, MOVES, WINNING_PATTERNS, search
 import time
 import random
 import abc
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from itertools import count
 from math import sqrt, log
 
 
+def random_rollout(x, o, turn):
+    """
+    Play random moves until the game is over, and return the score relative to turn.
+
+    The game is given directly by the X-board, O-board and player to move, so
+    that no Board objects need to be created on the way.
+    """
+    player = turn
+    while True:
+        bb = o if player == CROSS else x
+        for pattern in WINNING_PATTERNS:
+            if (bb & pattern) == pattern:
+                return -1 if player == turn else 1
+        taken = x | o
+        if taken == 0x1FF:
+            return 0
+        # Pick a random index with getrandbits, rejecting those that are out of range.
+        # This is unbiased, and cheaper than random.choice.
+        moves = MOVES[taken]
+        n = len(moves)
+        k = n.bit_length()
+        i = random.getrandbits(k)
+        while i >= n:
+            i = random.getrandbits(k)
+        move = moves[i]
+        if player == CROSS:
+            x |= move
+        else:
+            o |= move
+        player = NOUGHT if player == CROSS else CROSS
+
+
+try:
+    # Optional compiled rollouts, see tictactoe_c.pyx.
+    from tictactoe_c import random_rollout_c as random_rollout, seed_c
+except ImportError:
+    seed_c = None
+
+
+def seed(n):
+    """Seed the random rollouts, including the compiled ones if available."""
+    random.seed(n)
+    if seed_c is not None:
+        seed_c(n)
+
+
 class RolloutPolicy(abc.ABC):
     """A callable that assigns a score to board states."""
 
@@ -42,14 +90,16 @@ class RolloutPolicy(abc.ABC):
         """Return an evaluation for the board. Must correctly handle decided boards."""
         pass
 
+    def batch(self, boards):
+        """Return a list of evaluations for each of the boards."""
+        return [self(board) for board in boards]
+
 
 class RandomRollout(RolloutPolicy):
     """Rollout games based on random moves."""
 
     def __call__(self, board):
-        while not board.is_decided:
-            board = board.do_move(random.choice(list(board.moves())))
-        return board.score
+        return random_rollout(board.squares[CROSS], board.squares[NOUGHT], board.turn)
 
 
 class PerfectRollout(RolloutPolicy):
@@ -70,17 +120,21 @@ class Node(object):
     Of note is simply the attributes stored in the constructor.
     """
 
-    def __init__(self, board, parent=None):
+    __slots__ = ("board", "N", "W", "children", "_decided", "_terminal_score")
+
+    def __init__(self, board):
         self.board = board
-        self.parent = parent
 
         self.N = 0  # Visit count.
         self.W = 0  # Total score.
-        self.children = []
+        self.children = ()
+
+        # The board never changes, so whether the game is over is only computed once.
+        self._decided, self._terminal_score = board.is_decided_and_score
 
     @property
     def is_leaf(self):
-        return self.board.is_decided
+        return self._decided
 
     @property
     def has_children(self):
@@ -90,59 +144,124 @@ class Node(object):
     def can_be_expanded(self):
         return not self.has_children and not self.is_leaf
 
-    def expand(self):
-        assert self.can_be_expanded
-        self.children = [
-            Node(self.board.do_move(move), parent=self) for move in self.board.moves()
-        ]
+    def expand(self, transpositions):
+        """
+        Create the child nodes.
 
-    def rollout_and_update(self, rollout_policy):
+        Positions found in the transposition table reuse the existing node,
+        so the tree is really a directed acyclic graph.
+        """
+        x, o = self.board.squares
+        turn = self.board.turn
+        children = []
+        for move in self.board.moves():
+            # Look up the position before creating a Board for it, so that
+            # transpositions cost no allocations.
+            if turn == CROSS:
+                key = (x | move, o, NOUGHT)
+            else:
+                key = (x, o | move, CROSS)
+            child = transpositions.get(key)
+            if child is None:
+                child = transpositions[key] = Node(self.board.do_move(move))
+            children.append(child)
+        self.children = tuple(children)
+
+    def rollout_and_update(self, rollout_policy, path, executor=None):
         """
         Assign W/L/D score to every child node and update statistics.
 
-        This will propagate the update up to all parent nodes.
+        This will propagate the update up along the path, the list of nodes
+        traversed from the root to get to this node. A node can have several
+        parents, so we follow the path that was actually searched.
 
         The rollout policy defines some strategy for assigning a score to the board.
+        If an executor is given, the children are evaluated in parallel.
         """
-        paths = self.children
         # In case of a leaf node, we just evaluate on our self, as there are no children.
+        # The outcome is already known, so there is no need to consult the policy.
         if self.is_leaf:
-            paths = [self]
-        for path in paths:
-            outcome = rollout_policy(path.board)
-            path.update_stats(outcome)
-
-    def update_stats(self, outcome):
+            self.update_terminal(path)
+            return
+        children = self.children
+        if executor is not None and len(children) > 1:
+            outcomes = executor.map(rollout_policy, [child.board for child in children])
+        else:
+            outcomes = [rollout_policy(child.board) for child in children]
+        self.update_children(outcomes, path)
+
+    def update_terminal(self, path):
+        """Add the known outcome of a decided game, and propagate upwards along the path."""
+        self.update_stats(self._terminal_score, path)
+
+    def update_children(self, outcomes, path):
+        """Add one rollout outcome to each child, and propagate upwards along the path."""
+        children = self.children
+        total = 0
+        for child, outcome in zip(children, outcomes):
+            child.W += outcome
+            child.N += 1
+            total += outcome
+        # All the child outcomes are propagated upwards in one go.
+        self.update_stats(-total, path, visits=len(children))
+
+    def update_stats(self, outcome, path, visits=1):
         """
-        Update stats with the new outcome, and propagate upwards.
+        Update stats with the new outcome, and propagate upwards along the path.
 
-        Note that we send the negated outcome to the parent, as they have the
+        The outcome may be the sum of several rollouts, given by visits.
+        Note that the parents get the negated outcome, as they have the
         opposite perspective.
         """
         self.W += outcome
-        self.N += 1
-        if self.parent:
-            self.parent.update_stats(-outcome)
+        self.N += visits
+        for node in reversed(path):
+            outcome = -outcome
+            node.W += outcome
+            node.N += visits
 
-    def uct_inverted(self, control_parameter=0):
+    def add_virtual_loss(self, path, n=1):
         """
-        Compute the negated UCT score.
+        Count n virtual losses for every node that an evaluation of this node will update.
 
-        This assigns a large value if this node is desirable from
-        the parents point of view. Depending on the control parameter,
-        we might assign this node a high score even if it is undesirable
-        for the parent, if it has not been explored enough.
+        That is the path, this node and its children. This makes the nodes look
+        worse to the parent choosing them, so that other paths are preferred until
+        the real outcomes are known. Pass a negative n to remove them again.
         """
-        return -self.W / self.N + control_parameter * sqrt(log(self.parent.N) / self.N)
+        nodes = path + [self]
+        if not self.is_leaf:
+            nodes += self.children
+        for node in nodes:
+            node.W += n
+            node.N += n
 
     def max_uct_child(self, control_parameter=0):
-        """Return the child node with maximum UCT score."""
-        assert not self.can_be_expanded
+        """
+        Return the child node with maximum UCT score.
+
+        The score of a child is the negated UCT score
+
+            -W / N + control_parameter * sqrt(log(parent N) / N),
+
+        which is large if the child is desirable from our point of view.
+        Depending on the control parameter, we might pick a child even if it
+        is undesirable for us, if it has not been explored enough. A child that
+        has never been visited, e.g. because its rollout failed, has infinite
+        score and is picked first.
+        """
         if self.is_leaf:
             return self
-        return max(
-            self.children, key=lambda child: child.uct_inverted(control_parameter)
-        )
+        # The parent's part of the exploration term is the same for all children,
+        # so it is only computed once.
+        c = control_parameter * sqrt(log(self.N)) if self.N > 0 else 0
+        best, best_score = None, -float("inf")
+        for child in self.children:
+            if child.N == 0:
+                return child
+            score = -child.W / child.N + c / sqrt(child.N)
+            if score > best_score:
+                best, best_score = child, score
+        return best
 
     def __str__(self):
         return "{}\nW/N = {:.2f}, N = {}".format(
@@ -168,7 +287,7 @@ class Node(object):
 class MctsTree(object):
     """A Monte Carlo Search Tree."""
 
-    def __init__(self, board, rollout_policy=RandomRollout()):
+    def __init__(self, board, rollout_policy=RandomRollout(), executor=None):
         """
         Define a new search tree starting at the given position.
 
@@ -178,12 +297,25 @@ class MctsTree(object):
             A game object defining the board to search, see tictactoe.Board
         rollout_policy: RolloutPolicy, optional
             Define the policy to use to assign scores to board states. Default is RandomRollout.
+        executor: concurrent.futures.Executor, optional
+            If given, the rollouts of the children of each expanded node are run in parallel
+            using the executor. A ThreadPoolExecutor only helps with the compiled rollouts
+            from tictactoe_c, which release the GIL. Default is to run rollouts serially.
         """
         self.root = Node(board)
         self.rollout_policy = rollout_policy
+        self.executor = executor
+
+        # Transposition table, mapping (X-board, O-board, turn) to the node for that position.
+        self._tt = {}
 
     def search(
-        self, secs, control_parameter=lambda *args: 1, terminate=lambda *args: False
+        self,
+        secs,
+        control_parameter=lambda *args: 1,
+        terminate=lambda *args: False,
+        batch_size=1,
+        n_threads=1,
     ):
         """
         Perform a Monte Carlo Tree search from the root position.
@@ -202,6 +334,15 @@ class MctsTree(object):
             A function of the starting time and the number of iterations that have run,
             which returns True if the search should stop.
             Example: lambda t0, it: it >= 1000 will stop after 1000 iterations.
+        batch_size: int, optional
+            How many leaves to select and evaluate together in each iteration. The
+            rollouts of a batch are done with a single call to rollout_policy.batch.
+            Default is 1.
+        n_threads: int, optional
+            How many threads to search the tree with concurrently. Each thread evaluates
+            one leaf per iteration, and batch_size is not used. Virtual losses keep the
+            threads from all searching the same path. This only helps with the compiled
+            rollouts from tictactoe_c, which release the GIL. Default is 1.
 
         Returns
         -------
@@ -211,33 +352,136 @@ class MctsTree(object):
         """
         t0 = time.time()
 
+        if n_threads > 1:
+            self._search_threaded(n_threads, t0, secs, control_parameter, terminate)
+            return max(self.root.children, key=lambda child: child.N)
+
         for iteration in count(1):
-            self._mct_expand(control_parameter(t0, iteration))
+            if batch_size == 1:
+                self._mct_expand(control_parameter(t0, iteration))
+            else:
+                self._mct_expand_batch(batch_size, control_parameter(t0, iteration))
             if time.time() - t0 > secs or terminate(t0, iteration):
                 break
 
         return max(self.root.children, key=lambda child: child.N)
 
-    def _mct_expand(self, control_parameter=0):
-        """Perform one iteration of MCTS."""
+    def _search_threaded(self, n_threads, t0, secs, control_parameter, terminate):
+        """
+        Run the iterations of search in n_threads threads, until one of them decides to stop.
+
+        If an iteration raises in any of the threads, all of them stop, and the
+        error is raised here.
+        """
+        lock = threading.Lock()
+        iterations = count(1)
+        done = threading.Event()
+
+        def work():
+            try:
+                while not done.is_set():
+                    with lock:
+                        iteration = next(iterations)
+                    self._mct_expand_threaded(lock, control_parameter(t0, iteration))
+                    if time.time() - t0 > secs or terminate(t0, iteration):
+                        break
+            finally:
+                done.set()
+
+        with ThreadPoolExecutor(n_threads) as pool:
+            futures = [pool.submit(work) for _ in range(n_threads)]
+        for future in futures:
+            future.result()
+
+    def _mct_expand_threaded(self, lock, control_parameter=0):
+        """
+        Perform one iteration of MCTS, with other threads doing the same.
+
+        The tree is only changed while holding the lock, but the rollouts are
+        done without it so that they can run in parallel.
+        """
+        with lock:
+            node, path = self._select(control_parameter)
+            node.add_virtual_loss(path)
+
+        outcomes = None
+        try:
+            if not node.is_leaf:
+                outcomes = [self.rollout_policy(child.board) for child in node.children]
+        finally:
+            # Replace the virtual loss with the real outcomes, or just remove it
+            # if the rollouts failed. The children are then left unvisited, and
+            # max_uct_child picks them first in later searches.
+            with lock:
+                node.add_virtual_loss(path, -1)
+                if node.is_leaf:
+                    node.update_terminal(path)
+                elif outcomes is not None:
+                    node.update_children(outcomes, path)
+
+    def _select(self, control_parameter=0):
+        """Return a node to evaluate along with the path to it, expanding it if possible."""
 
         # Traverse down the tree, picking nodes according to UCT scores.
         node = self.root
+        path = []
         while node.has_children:
+            path.append(node)
             node = node.max_uct_child(control_parameter)
 
         # At this point we either have a leaf node or an unexpanded node.
         # In case of the latter we expand its children.
         if node.can_be_expanded:
-            node.expand()
+            node.expand(self._tt)
+        return node, path
+
+    def _mct_expand(self, control_parameter=0):
+        """Perform one iteration of MCTS."""
+        node, path = self._select(control_parameter)
 
         # Evaluate the score of the node, or the score of all the children,
         # and propagate updates back up the tree.
-        node.rollout_and_update(self.rollout_policy)
+        node.rollout_and_update(self.rollout_policy, path, self.executor)
+
+    def _mct_expand_batch(self, batch_size, control_parameter=0):
+        """Perform one iteration of MCTS, selecting and evaluating batch_size leaves together."""
+
+        # Virtual losses steer each selection away from the ones before it.
+        # They are always removed again, even if the rollouts fail.
+        selected = []
+        try:
+            for _ in range(batch_size):
+                node, path = self._select(control_parameter)
+                node.add_virtual_loss(path)
+                selected.append((node, path))
+
+            boards = [
+                child.board
+                for node, _ in selected
+                if not node.is_leaf
+                for child in node.children
+            ]
+            if self.executor is not None:
+                outcomes = list(self.executor.map(self.rollout_policy, boards))
+            else:
+                outcomes = self.rollout_policy.batch(boards)
+        finally:
+            for node, path in selected:
+                node.add_virtual_loss(path, -1)
+
+        # Now add the real outcomes.
+        i = 0
+        for node, path in selected:
+            if node.is_leaf:
+                node.update_terminal(path)
+            else:
+                n = len(node.children)
+                node.update_children(outcomes[i : i + n], path)
+                i += n
 
 
 if __name__ == "__main__":
-    random.seed(2018)
+    seed(2018)
     b = Board().do_move(16).do_move(1).do_move(256).do_move(64)
     tree = MctsTree(b, rollout_policy=RandomRollout())
 
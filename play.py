@@ -2,12 +2,13 @@
 This module defines a common interface for playing different AIs against humans
 or other AIs.
 """
+import multiprocessing
 import random
 import sys
 import time
 from abc import ABC, abstractmethod
 from tictactoe import Board, search
-from mcts import MctsTree, RandomRollout, PerfectRollout
+from mcts import MctsTree, RandomRollout, PerfectRollout, seed
 
 
 class Player(ABC):
@@ -27,8 +28,9 @@ class HumanPlayer(Player):
 
     def make_move(self, board):
         """Ask for a move until a legal one is given."""
+        legal = set(board.moves())
         move = None
-        while move not in board.moves():
+        while move not in legal:
             try:
                 text = input("Enter move (1-9): ")
                 move = 1 << int(text) - 1
@@ -53,20 +55,76 @@ class MctsPlayer(Player):
 
     Adjust strength by changing the amount of allowed iterations/thinking time,
     exploration control parameter and rollout policy.
+
+    With n_workers > 1, that many independent trees are searched in parallel
+    processes, and the move with the most visits in total is played. The worker
+    processes are started on the first move and reused for later moves. Call
+    close(), or use the player as a context manager, to shut them down.
     """
 
-    def __init__(self, rollout_policy=RandomRollout()):
+    def __init__(self, rollout_policy=RandomRollout(), n_workers=1):
+        if n_workers < 1:
+            raise ValueError("n_workers must be at least 1, got {}".format(n_workers))
         self.rollout_policy = rollout_policy
+        self.n_workers = n_workers
+        self._pool = None
+
+    def close(self):
+        """Shut down the worker processes, if any are running."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def make_move(self, board):
         """Pick the most preferred, legal move."""
-        tree = MctsTree(board, rollout_policy=self.rollout_policy)
-        new_pos = tree.search(
-            secs=float("inf"),
-            control_parameter=lambda t0, it: 0.999 ** (it),
-            terminate=lambda t0, it: it > 5000,
-        )
-        return new_pos.board
+        if self.n_workers == 1:
+            tree = MctsTree(board, rollout_policy=self.rollout_policy)
+            return _mcts_search(tree).board
+
+        # Boards are sent to the workers as (X-board, O-board, turn, depth).
+        state = (board.squares[0], board.squares[1], board.turn, board.depth)
+        jobs = [
+            (state, self.rollout_policy, random.getrandbits(32))
+            for _ in range(self.n_workers)
+        ]
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(self.n_workers)
+        results = self._pool.map(_mcts_visit_counts, jobs)
+
+        visits = {}
+        for counts in results:
+            for move, n in counts:
+                visits[move] = visits.get(move, 0) + n
+        return board.do_move(max(visits, key=visits.get))
+
+
+def _mcts_search(tree):
+    """Search the tree, and return the node for the best move."""
+    return tree.search(
+        secs=float("inf"),
+        control_parameter=lambda t0, it: 0.999 ** (it),
+        terminate=lambda t0, it: it > 5000,
+    )
+
+
+def _mcts_visit_counts(job):
+    """Search a tree in a worker process, and return [(move, N)] for each root move."""
+    (x, o, turn, depth), rollout_policy, worker_seed = job
+    seed(worker_seed)
+    board = Board((x, o), turn, depth)
+    tree = MctsTree(board, rollout_policy=rollout_policy)
+    _mcts_search(tree)
+    return [
+        (child.board.squares[turn] ^ board.squares[turn], child.N)
+        for child in tree.root.children
+    ]
 
 
 def play(player1=HumanPlayer(), player2=MctsPlayer(), verbose=True):
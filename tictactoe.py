@@ -26,19 +26,33 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import functools
 import math
+import os
+
+try:
+    # Optional compiled search, see tictactoe_c.pyx.
+    from tictactoe_c import search_c
+except ImportError:
+    search_c = None
 
 CROSS, NOUGHT = 0, 1
-PLAYERS = [CROSS, NOUGHT]
 
 # Winning patterns encoded in bit patterns.
 # E.g. three in a row in the top row is
 #   448 = 0b111000000
-WINNING_PATTERNS = [
+WINNING_PATTERNS = (
         448, 56, 7,   # Rows
         292, 146, 73, # Columns
         273, 84       # Diagonals
-]
+)
+
+# Available moves for each of the 512 possible sets of occupied squares,
+# ordered from the bottom right corner to the top left.
+MOVES = tuple(
+    tuple(1 << i for i in reversed(range(9)) if not (taken >> i) & 1)
+    for taken in range(512)
+)
 
 
 class Board(object):
@@ -52,23 +66,30 @@ class Board(object):
 
         X|O|X
         -+-+-          CROSS        NOUGHT
-        O|X|O   = [ 0b101010101, 0b010101010 ]
+        O|X|O   = ( 0b101010101, 0b010101010 )
         -+-+-
         X|O|X
     """
 
+    __slots__ = ("squares", "turn", "depth")
+
     def __init__(self, squares=(0, 0), turn=CROSS, depth=0):
-        self.squares = list(squares)  # First is X-board, second O-board.
+        self.squares = tuple(squares)  # First is X-board, second O-board.
         self.turn = turn
         self.depth = depth
 
     @property
     def score(self):
-        """Return +1 if self.turn has won, -1 for loss and 0 otherwise."""
-        for player in PLAYERS:
-            for pattern in WINNING_PATTERNS:
-                if (self.squares[player] & pattern) == pattern:
-                    return 1 if player == self.turn else -1
+        """
+        Return -1 if self.turn has lost and 0 otherwise.
+
+        Only the player who made the last move can have completed a row, so
+        that is the only bitboard we need to check.
+        """
+        bb = self.squares[1 - self.turn]
+        for pattern in WINNING_PATTERNS:
+            if (bb & pattern) == pattern:
+                return -1
         return 0
 
     @property
@@ -87,24 +108,22 @@ class Board(object):
         return CROSS if self.turn == NOUGHT else NOUGHT
 
     def moves(self):
-        """Generator for all possible moves."""
+        """Return a tuple of all possible moves."""
         # Every non-occupied square is a move.
-        taken = self.squares[CROSS] | self.squares[NOUGHT]
-        square = 256  # Bottom right corner.
-        while square:
-            if not (taken & square):
-                yield square
-            square = square >> 1
+        return MOVES[self.squares[CROSS] | self.squares[NOUGHT]]
 
     def do_move(self, move):
         """Return a board where the suggested move has been made."""
-        b = Board(
-            squares=self.squares[:],  # Copy squares.
+        x, o = self.squares
+        if self.turn == CROSS:
+            squares = (x | move, o)  # Apply move.
+        else:
+            squares = (x, o | move)
+        return Board(
+            squares=squares,
             turn=self.next_player,    # Swap player to move.
             depth=self.depth + 1,     # Increment depth.
         )
-        b.squares[self.turn] |= move  # Apply move.
-        return b
 
     def __repr__(self):
         """Return string representation of the board."""
@@ -123,40 +142,61 @@ class Board(object):
         return s
 
 
-def search(board, lower=-1, upper=1):
+def search(board):
     """
     Return score and best move, relative to board.turn.
 
     The search is an implementation of a depth-unlimited
     Negamax-algorithm, a variant of Minimax.
     """
+    if search_c is not None and not _WARMED_UP:
+        return search_c(board.squares[CROSS], board.squares[NOUGHT], board.turn)
+    return _search(board.squares[CROSS], board.squares[NOUGHT], board.turn)
+
+
+@functools.lru_cache(maxsize=None)
+def _search(x, o, turn):
+    """
+    Return score and best move for the position given by the X-board, O-board and turn.
 
+    Results are cached, so positions reachable by different move orders are only
+    searched once. With fewer than 5500 reachable positions, the searched tree is
+    small enough that there is no need for pruning, so every result is exact.
+    """
     # If game is over we know the score.
-    decided, score = board.is_decided_and_score
-    if decided:
-        return score, None
+    bb = o if turn == CROSS else x
+    for pattern in WINNING_PATTERNS:
+        if (bb & pattern) == pattern:
+            return -1, None
+    taken = x | o
+    if taken == 0x1FF:
+        return 0, None
 
     # Recursively explore the available moves, keeping
     # track of the best score and move to play.
     bestScore, bestMove = -float("inf"), None
 
-    for move in board.moves():
+    for move in MOVES[taken]:
 
         # v is score of position after the move.
-        v = -search(board.do_move(move), -upper, -lower)[0]
+        if turn == CROSS:
+            v = -_search(x | move, o, NOUGHT)[0]
+        else:
+            v = -_search(x, o | move, CROSS)[0]
 
         # New best move?
         if v > bestScore:
             bestScore = v
             bestMove = move
 
-        # Update lower bound. Guaranteed at least a score of max(lower, v).
-        lower = max(lower, v)
-
-        # Pruning: If lower bound equals the upper bound, the true score
-        # must be the currently best score. No need to explore other branches.
-        if lower >= upper:
-            break
-
     return bestScore, bestMove
 
+
+# Searching from the empty board fills the cache with every reachable position,
+# making later searches a single lookup. This uses the Python search even if the
+# compiled module is available, as search_c only returns the result for the root.
+# Set TICTACTOE_NO_SEARCH_WARMUP=1 to skip this at import, and search on demand
+# instead, with search_c if available.
+_WARMED_UP = not os.environ.get("TICTACTOE_NO_SEARCH_WARMUP")
+if _WARMED_UP:
+    _search(0, 0, CROSS)
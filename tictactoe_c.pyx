@@ -0,0 +1,204 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+
+"""
+Compiled versions of the hot paths of tictactoe.py and mcts.py.
+
+The game state is given by the X-board and O-board bitboards, along with the
+player to move, exactly as in tictactoe.Board. Build with `make python-ext`.
+Both tictactoe.py and mcts.py fall back to pure Python if this module is not
+available.
+
+MIT License
+Copyright 2018 Bendik Samseth
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in
+the Software without restriction, including without limitation the rights to
+use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+of the Software, and to permit persons to whom the Software is furnished to do
+so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+
+from libc.stdint cimport int8_t, uint32_t, uint64_t
+
+
+cdef extern from *:
+    int __builtin_popcount(unsigned int x) nogil
+
+
+cdef uint32_t FULL = 0x1FF
+
+# Same as tictactoe.WINNING_PATTERNS.
+cdef uint32_t[8] WINNING_PATTERNS = [448, 56, 7, 292, 146, 73, 273, 84]
+
+# Transposition table for search_c, indexed by (X-board << 9) | O-board.
+# An entry is 0 if the position has not been searched, and otherwise
+# (flag << 2) | (score + 2). Because of pruning a stored score may only be a
+# bound on the true score, which the flag indicates.
+cdef enum:
+    EXACT = 0
+    LOWER_BOUND = 1
+    UPPER_BOUND = 2
+cdef int8_t TABLE[1 << 18]
+
+# State for handing out random number generator seeds to random_rollout_c.
+# It is only used while holding the GIL, and each rollout then runs with its
+# own generator state, so rollouts in different threads never share one.
+# It is seeded from the OS at import and again in every forked child, so runs
+# and worker processes differ unless seeded explicitly with mcts.seed.
+cdef uint64_t SEED = 0
+
+
+cdef inline uint64_t splitmix64(uint64_t *state) nogil:
+    """Return the next output of a SplitMix64 generator, used to seed xorshift64*."""
+    cdef uint64_t z
+    state[0] += 0x9E3779B97F4A7C15ULL
+    z = state[0]
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL
+    return z ^ (z >> 31)
+
+
+cdef inline uint32_t xorshift64star(uint64_t *state) nogil:
+    """Return the next 32 random bits from a xorshift64* generator. The state must be non-zero."""
+    state[0] ^= state[0] >> 12
+    state[0] ^= state[0] << 25
+    state[0] ^= state[0] >> 27
+    return <uint32_t>((state[0] * 0x2545F4914F6CDD1DULL) >> 32)
+
+
+cdef inline int score_c(uint32_t x, uint32_t o, int turn) nogil:
+    """Return -1 if turn has lost and 0 otherwise."""
+    cdef uint32_t bb = o if turn == 0 else x
+    cdef int i
+    for i in range(8):
+        if (bb & WINNING_PATTERNS[i]) == WINNING_PATTERNS[i]:
+            return -1
+    return 0
+
+
+cdef int negamax(uint32_t x, uint32_t o, int turn, int lower, int upper,
+                 uint32_t *best_move) nogil:
+    """
+    Return the score relative to turn, searching with alpha-beta pruning.
+
+    If best_move is not NULL the best move is stored in it, in which case the
+    transposition table is not consulted for this position.
+    """
+    cdef uint32_t index = (x << 9) | o
+    cdef int8_t entry = TABLE[index]
+    cdef int flag, score, v, original_lower = lower
+    cdef int best_score = -2
+    cdef uint32_t move, empty
+
+    if entry and best_move == NULL:
+        flag, score = entry >> 2, (entry & 3) - 2
+        if (flag == EXACT
+                or (flag == LOWER_BOUND and score >= upper)
+                or (flag == UPPER_BOUND and score <= lower)):
+            return score
+
+    score = score_c(x, o, turn)
+    empty = FULL & ~(x | o)
+    if score or not empty:
+        return score
+
+    # Moves are explored from the bottom right corner, like Board.moves.
+    move = 256
+    while move:
+        if empty & move:
+            if turn == 0:
+                v = -negamax(x | move, o, 1, -upper, -lower, NULL)
+            else:
+                v = -negamax(x, o | move, 0, -upper, -lower, NULL)
+            if v > best_score:
+                best_score = v
+                if best_move != NULL:
+                    best_move[0] = move
+            if v > lower:
+                lower = v
+            if lower >= upper:
+                break
+        move >>= 1
+
+    if best_score <= original_lower and best_score > -1:
+        flag = UPPER_BOUND
+    elif best_score >= upper and best_score < 1:
+        flag = LOWER_BOUND
+    else:
+        flag = EXACT
+    TABLE[index] = <int8_t>((flag << 2) | (best_score + 2))
+    return best_score
+
+
+def search_c(uint32_t x, uint32_t o, int turn, int lower=-1, int upper=1):
+    """Return score and best move, relative to turn. See tictactoe.search."""
+    cdef uint32_t move = 0
+    cdef int score = negamax(x, o, turn, lower, upper, &move)
+    return score, (move if move else None)
+
+
+cdef int rollout(uint32_t x, uint32_t o, int turn, uint64_t state) nogil:
+    """
+    Play random moves until the game is over, and return the score relative to turn.
+
+    Random numbers are drawn from a xorshift64* generator starting at the given non-zero state.
+    """
+    cdef int player = turn
+    cdef uint32_t empty, move
+    cdef int n
+    while True:
+        if score_c(x, o, player):
+            return -1 if player == turn else 1
+        empty = FULL & ~(x | o)
+        if not empty:
+            return 0
+        # Clear n random lowest set bits, and pick the lowest one remaining.
+        n = xorshift64star(&state) % __builtin_popcount(empty)
+        while n:
+            empty &= empty - 1
+            n -= 1
+        move = empty & (~empty + 1)
+        if player == 0:
+            x |= move
+        else:
+            o |= move
+        player = 1 - player
+
+
+def random_rollout_c(uint32_t x, uint32_t o, int turn):
+    """Play random moves until the game is over, and return the score relative to turn."""
+    # Draw this rollout's generator state while still holding the GIL.
+    cdef uint64_t state = splitmix64(&SEED) | 1
+    cdef int score
+    with nogil:
+        score = rollout(x, o, turn, state)
+    return score
+
+
+def seed_c(uint64_t seed):
+    """Seed the random number generator used by random_rollout_c."""
+    global SEED
+    SEED = seed
+
+
+def _seed_from_os():
+    seed_c(int.from_bytes(os.urandom(8), "little"))
+
+
+_seed_from_os()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_seed_from_os)